@@ -7,21 +7,26 @@
 '''
 
 
+import io
 import os
 import sys
-import math
-import array
 import pickle
+import weakref
 import zipfile
-import requests
+import threading
 import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-import seaborn as sns
-from Utils_ import gini
 import scipy.sparse as sps
-import matplotlib.pyplot as plt
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
 
 class DataReader(object):
     """
@@ -44,6 +49,7 @@ class DataReader(object):
                  use_local=True,
                  force_rebuild=False,
                  save_local=True,
+                 compress_npz=False,
                  min_ratings=1,
                  duplicate='first',
                  verbose=True,
@@ -59,8 +65,10 @@ class DataReader(object):
             raise AttributeError('Split ratio of train, test and validation must sum up to 1')
 
         self.use_local = use_local
+        self.transposed_cache = {}
         self.force_rebuild = force_rebuild
         self.save_local = save_local
+        self.compress_npz = compress_npz
         self.min_ratings = min_ratings
         self.verbose = verbose
 
@@ -78,16 +86,20 @@ class DataReader(object):
             self.implicit = implicit
 
 
-        self.config = {
+        # The full URM depends only on urm_config, so a change in split_config requires only re-splitting it
+        self.urm_config = {
             'use_cols': self.use_cols,
-            'split_ratio': self.split_ratio,
-            'stratified_on': self.stratified_on,
             'header': self.header,
             'delim': self.delimiter,
             'implicit': self.implicit,
             'remove_top_pop': self.remove_top_pop,
+            'duplicate': self.duplicate
+        }
+
+        self.split_config = {
+            'split_ratio': self.split_ratio,
+            'stratified_on': self.stratified_on,
             'min_ratings': self.min_ratings,
-            'duplicate': self.duplicate,
             'seed': seed
         }
 
@@ -107,26 +119,62 @@ class DataReader(object):
         if os.path.isfile(ratings_file):
             self.URM = self.build_URM(file=ratings_file, use_cols=self.use_cols, delimiter=self.delimiter,
                                       header=self.header, save_local=self.save_local, remove_top_pop=self.remove_top_pop,
-                                      duplicate=self.duplicate, verbose=self.verbose)
+                                      duplicate=self.duplicate, verbose=self.verbose, compress_npz=self.compress_npz)
             
             if split:
                 self.URM_train, \
                 self.URM_test, \
                 self.URM_validation = self.split_urm(self.URM, split_ratio=self.split_ratio, save_local=self.save_local,
                                                     min_ratings=self.min_ratings, verbose=self.verbose, implicit=self.implicit,
-                                                    save_dir=os.path.dirname(ratings_file))
+                                                    save_dir=os.path.dirname(ratings_file), compress_npz=self.compress_npz)
 
-            try:
-                with open(os.path.join(os.path.dirname(ratings_file), 'config.pkl'), 'wb') as f:
-                    pickle.dump(self.config, f)
-            except AttributeError:
-                print('config is not initialized in ' + self.__class__.__name__ + '! No config saved!', file=sys.stderr)
+            # The config describes the matrices on disk, which are only replaced when saving locally
+            if self.save_local:
+                try:
+                    self.save_config(os.path.dirname(ratings_file), split)
+                except AttributeError:
+                    print('config is not initialized in ' + self.__class__.__name__ + '! No config saved!', file=sys.stderr)
 
         else:
             print(ratings_file + ' not found. Building remotely...')
             self.build_remote()
 
 
+    def save_config(self, save_dir, split=True):
+        """
+        Saves the configurations the local matrices were built with
+
+        Parameters
+        ----------
+        save_dir: str
+            Directory where the matrices are saved.
+
+        split: boolean, default True
+            Flag indicating whether the train-test-validation matrices were also built. If False, any previous
+            split configuration is removed since those matrices do not come from the current full URM.
+        """
+        with open(os.path.join(save_dir, 'urm_config.pkl'), 'wb') as f:
+            pickle.dump(self.urm_config, f)
+
+        split_config_path = os.path.join(save_dir, 'split_config.pkl')
+        if split:
+            with open(split_config_path, 'wb') as f:
+                pickle.dump(self.split_config, f)
+        elif os.path.isfile(split_config_path):
+            os.remove(split_config_path)
+
+
+    def load_config(self, path):
+        """
+        Loads a configuration saved by save_config. Returns None if it does not exist.
+        """
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
     def get_ratings_file(self):
         """
         Downloads the dataset and sets self.ratings_file. If downlaoded file is a zip file, it extracts it, otherwise
@@ -156,21 +204,21 @@ class DataReader(object):
         self.get_ratings_file()
         self.URM = self.build_URM(file=self.ratings_file, use_cols=self.use_cols, delimiter=self.delimiter,
                                     header=self.header, save_local=self.save_local, remove_top_pop=self.remove_top_pop,
-                                    duplicate=self.duplicate, verbose=self.verbose)
+                                    duplicate=self.duplicate, verbose=self.verbose, compress_npz=self.compress_npz)
 
         if split:
             self.URM_train, \
             self.URM_test, \
             self.URM_validation = self.split_urm(self.URM, split_ratio=self.split_ratio, save_local=self.save_local,
                                                     min_ratings=self.min_ratings, verbose=self.verbose, implicit=self.implicit,
-                                                    save_dir=os.path.dirname(self.ratings_file))
+                                                    save_dir=os.path.dirname(self.ratings_file), compress_npz=self.compress_npz)
 
-        try:
-            with open(os.path.join(os.path.dirname(self.ratings_file), 'config.pkl'), 'wb') as f:
-                pickle.dump(self.config, f)
-        except AttributeError:
-            print('config is not initialized in ' + self.__class__.__name__ + '!', file=sys.stderr)
-            raise
+        if self.save_local:
+            try:
+                self.save_config(os.path.dirname(self.ratings_file), split)
+            except AttributeError:
+                print('config is not initialized in ' + self.__class__.__name__ + '!', file=sys.stderr)
+                raise
 
 
     def download_url(self, url, verbose=True):
@@ -193,12 +241,15 @@ class DataReader(object):
             absolute path of the downloaded file from the PROJECT ROOT
         """
 
+        # Imported here since only downloads need it
+        import requests
+
         response = requests.get(url, stream=True)
         if response.status_code == 200:
             total_size = 0
             if 'content-length' in response.headers.keys():
                 total_size = int(response.headers['content-length'])
-            chunk_size = 1024 * 4
+            chunk_size = 1024 * 1024
 
             filename = url.split('/')[-1]
             abs_path = os.path.join(self.all_datasets_dir,  self.dataset_dir, filename)
@@ -211,7 +262,7 @@ class DataReader(object):
                 for chunk in response.iter_content(chunk_size=chunk_size):
                     if chunk:
                         f.write(chunk)
-                        pbar.update(chunk_size)
+                        pbar.update(len(chunk))
                 pbar.close()
             return abs_path
 
@@ -313,79 +364,72 @@ class DataReader(object):
         
         Returns:
         --------
-        rows: array.array
-        cols: array.array
-        data: array.array
+        rows: np.ndarray
+        cols: np.ndarray
+        data: np.ndarray
         """
 
-        rows = array.array('I')
-        cols = array.array('I')
-        data = array.array('f')
-
-        unique_interactions = {}
-
-        with open(file, 'r') as f:
-
-            if header:
-                f.readline()
-
-            if verbose:
-                print('Filling the full URM...')
-
-            # # Netflix Dataset requires preprocessing and it's big so
-            # # it is better to generate the matrices in one reading
-            # if netflix_process:
-            #     current_item_id = -1
-
-            #     for line in f:
-            #         row_data = line.split(delimiter)
-
-            #         if len(row_data) == 1:
-            #             # This is an item id
-            #             current_item_id = int(row_data[0][:-2])
-            #         else:
-            #             rows.append(int(row_data[0]))
-            #             data.append(int(row_data[1]))
-            #             cols.append(current_item_id)
-
-            # else:
-            if self.implicit:
-                for i, line in enumerate(f):
-                    row_data = line.split(delimiter)
-                    r = int(row_data[use_cols['user_id']])
-                    c = int(row_data[use_cols['item_id']])
-
-                    key = str(r) + '_' + str(c)
-                    if unique_interactions.get(key, False):
-                        continue
-                    else:
-                        unique_interactions[key] = i
-
-                    rows.append(r)
-                    cols.append(c)
-                    data.append(1.0)
-                    
-            else:
-                for i, line in enumerate(f):
-                    row_data = line.split(delimiter)
-                    r = int(row_data[use_cols['user_id']])
-                    c = int(row_data[use_cols['item_id']])
-                    d = float(row_data[use_cols['rating']])
-
-                    key = str(r) + '_' + str(c)
-                    idx = unique_interactions.get(key, False)
-                    if idx:
-                        if duplicate == 'last':
-                            data[idx] = d
-                        continue
-                    else:
-                        unique_interactions[key] = i
-
-                    rows.append(r)
-                    cols.append(c)
-                    data.append(d)
+        if verbose:
+            print('Filling the full URM...')
+
+        # Read only the needed columns; ratings are not parsed at all for implicit datasets
+        columns = {'user_id': use_cols['user_id'], 'item_id': use_cols['item_id']}
+        if not self.implicit:
+            columns['rating'] = use_cols['rating']
+
+        # Both pyarrow and the pandas C parser support only single character delimiters, e.g. Movielens 1M uses `::`.
+        # Instead of falling back to the pure Python parser, replace the delimiter in memory with the ASCII unit
+        # separator which never appears in ratings' files
+        if len(delimiter) > 1:
+            with open(file, 'rb') as f:
+                file = io.BytesIO(f.read().replace(delimiter.encode(), b'\x1f'))
+            delimiter = '\x1f'
+
+        # pyarrow parses the file in parallel blocks, otherwise use the pandas C parser
+        if pa is not None:
+            types = {'user_id': pa.uint32(), 'item_id': pa.uint32(), 'rating': pa.float32()}
+            names = {k: 'f' + str(v) for k, v in columns.items()}
+            table = pacsv.read_csv(file,
+                                   read_options=pacsv.ReadOptions(use_threads=True, block_size=1 << 23,
+                                                                  skip_rows=1 if header else 0,
+                                                                  autogenerate_column_names=True),
+                                   parse_options=pacsv.ParseOptions(delimiter=delimiter),
+                                   convert_options=pacsv.ConvertOptions(include_columns=list(names.values()),
+                                                                        column_types={names[k]: types[k] for k in names}))
+            arrays = {k: table.column(names[k]).to_numpy() for k in names}
+            del table
+        else:
+            dtypes = {'user_id': np.uint32, 'item_id': np.uint32, 'rating': np.float32}
+            df = pd.read_csv(file, sep=delimiter, header=None, skiprows=1 if header else 0,
+                             usecols=sorted(columns.values()),
+                             dtype={columns[k]: dtypes[k] for k in columns},
+                             engine='c', memory_map=isinstance(file, str))
+            arrays = {k: df[columns[k]].to_numpy() for k in columns}
+            del df
+
+        rows = arrays['user_id']
+        cols = arrays['item_id']
+
+        # Keep only the first/last occurrence of each (user, item) pair, preserving file order
+        keys = rows.astype(np.uint64)
+        keys <<= np.uint64(32)
+        keys |= cols
+        if duplicate == 'last':
+            _, last = np.unique(keys[::-1], return_index=True)
+            keep = np.sort(len(keys) - 1 - last)
+        else:
+            _, keep = np.unique(keys, return_index=True)
+            keep.sort()
+        del keys
+
+        rows = rows[keep]
+        cols = cols[keep]
+        if self.implicit:
+            data = np.ones(len(keep), dtype=np.float32)
+        else:
+            data = arrays['rating'][keep]
 
-        del unique_interactions
+        del arrays
         return rows, cols, data
     
     
@@ -397,7 +441,8 @@ class DataReader(object):
                   save_local=True,
                   remove_top_pop=0.0,
                   duplicate='first',
-                  verbose=True):
+                  verbose=True,
+                  compress_npz=False):
         """
         Builds the URM from interactions data file.
 
@@ -427,6 +472,9 @@ class DataReader(object):
         verbose: boolean, default True
             Flag indicating whether logging should be printed out.
 
+        compress_npz: boolean, default False
+            Flag indicating whether the locally saved arrays should be compressed.
+
 
         Returns
         -------
@@ -434,31 +482,66 @@ class DataReader(object):
             The full URM in COO format.
         """
 
-        rows, cols, data = self.read_interactions(file, use_cols, delimiter, header, duplicate, verbose)
+        # Parsing the ratings' file is deterministic, so its output is cached next to it and reused on every rebuild
+        # as long as neither the file nor the parsing parameters change. Forced rebuilds always parse the file
+        raw_coo_path = os.path.join(os.path.dirname(file), 'raw_coo.npz')
+        file_stat = os.stat(file)
+        parse_config = str({'use_cols': use_cols, 'delim': delimiter, 'header': header, 'duplicate': duplicate,
+                            'implicit': self.implicit, 'size': file_stat.st_size, 'mtime': file_stat.st_mtime})
 
-        unique_items, item_counts = np.unique(cols, return_counts=True)
+        rows = None
+        if not self.force_rebuild and os.path.isfile(raw_coo_path):
+            try:
+                # The file is opened here since np.load leaves it open when it is not a valid npz
+                with open(raw_coo_path, 'rb') as f, np.load(f) as raw_coo:
+                    if str(raw_coo['config']) == parse_config:
+                        if verbose:
+                            print('Loading parsed interactions locally...')
+                        rows, cols, data = raw_coo['r'], raw_coo['c'], raw_coo['d']
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                # A damaged cache, e.g. from an interrupted run, is parsed again and overwritten
+                print('Parsed interactions in ' + raw_coo_path + ' are damaged! Parsing the ratings\' file again...',
+                      file=sys.stderr)
+                rows = None
+
+        if rows is None:
+            rows, cols, data = self.read_interactions(file, use_cols, delimiter, header, duplicate, verbose)
+            if save_local:
+                # Write to a temporary file and then replace, so that an interrupted run never leaves a damaged cache
+                savez = np.savez_compressed if compress_npz else np.savez
+                savez(raw_coo_path + '.tmp.npz', r=rows, c=cols, d=data, config=parse_config)
+                os.replace(raw_coo_path + '.tmp.npz', raw_coo_path)
 
         if remove_top_pop > 0.0:
+            unique_items, item_counts = np.unique(cols, return_counts=True)
             k = int(np.floor(len(unique_items) * remove_top_pop))
             sorted_indices = np.argsort(item_counts)[::-1]
-            unique_items = unique_items[sorted_indices][k:]
-            col_mask = np.isin(cols, unique_items)
-            cols = np.frombuffer(cols, dtype=np.int32)[col_mask]
-            rows = np.frombuffer(rows, dtype=np.int32)[col_mask]
-            if not isinstance(data, np.ndarray):
-                data = np.frombuffer(data, dtype=np.float32)[col_mask]
+            # Binary search each item id among the sorted ids to keep
+            keep = np.sort(unique_items[sorted_indices][k:])
+            if keep.size > 0:
+                idx = np.searchsorted(keep, cols)
+                col_mask = (idx < keep.size) & (keep[np.minimum(idx, keep.size - 1)] == cols)
             else:
-                data = data[col_mask]
-
-        unique_users = np.unique(rows)
+                col_mask = np.zeros(len(cols), dtype=np.bool_)
+            cols = cols[col_mask]
+            rows = rows[col_mask]
+            data = data[col_mask]
+
+        # Map user and item ids to contiguous row and column indices, ordered by id. factorize hashes the ids and
+        # sorts only the unique ones. Indices are stored as int32, the index dtype scipy uses, to avoid another
+        # copy when building the URM
+        coo_rows, unique_users = pd.factorize(rows, sort=True)
+        coo_cols, unique_items = pd.factorize(cols, sort=True)
+        coo_rows = coo_rows.astype(np.int32)
+        coo_cols = coo_cols.astype(np.int32)
 
         shape = (len(unique_users), len(unique_items))
 
-        self.row_to_user = dict(zip(unique_users, range(len(unique_users))))
-        self.col_to_item = dict(zip(unique_items, range(len(unique_items))))
-
-        coo_rows = pd.Series(rows).map(self.row_to_user).values
-        coo_cols = pd.Series(cols).map(self.col_to_item).values
+        # Row/column i of the URM holds user/item user_ids[i]/item_ids[i], the dict mappings are built on request
+        self.user_ids = unique_users
+        self.item_ids = unique_items
+        self.row_to_user_dict = None
+        self.col_to_item_dict = None
 
         self.URM = sps.coo_matrix((data, (coo_rows, coo_cols)), shape=shape, dtype=np.float32)
 
@@ -466,9 +549,9 @@ class DataReader(object):
             if verbose:
                 print('Saving full URM locally...')
 
-            sps.save_npz(os.path.join(os.path.dirname(file), 'URM'), self.URM, compressed=True)
-            np.save(os.path.join(os.path.dirname(file), 'row_to_user'), self.row_to_user, allow_pickle=True)
-            np.save(os.path.join(os.path.dirname(file), 'col_to_item'), self.col_to_item, allow_pickle=True)
+            sps.save_npz(os.path.join(os.path.dirname(file), 'URM'), self.URM, compressed=compress_npz)
+            np.save(os.path.join(os.path.dirname(file), 'row_to_user'), self.user_ids)
+            np.save(os.path.join(os.path.dirname(file), 'col_to_item'), self.item_ids)
 
         # Delete arrays to save space
         data, rows, cols = None, None, None
@@ -476,7 +559,27 @@ class DataReader(object):
         return self.URM
     
     
-    def split_urm(self, URM=None, split_ratio=[0.6, 0.2, 0.2], save_local=True, implicit=False, min_ratings=2, verbose=True, save_dir=None):
+    @property
+    def row_to_user(self):
+        """
+        Dict mapping the user ids of the ratings' file to the rows of the URM
+        """
+        if self.row_to_user_dict is None:
+            self.row_to_user_dict = dict(zip(self.user_ids.tolist(), range(len(self.user_ids))))
+        return self.row_to_user_dict
+
+
+    @property
+    def col_to_item(self):
+        """
+        Dict mapping the item ids of the ratings' file to the columns of the URM
+        """
+        if self.col_to_item_dict is None:
+            self.col_to_item_dict = dict(zip(self.item_ids.tolist(), range(len(self.item_ids))))
+        return self.col_to_item_dict
+
+
+    def split_urm(self, URM=None, split_ratio=[0.6, 0.2, 0.2], save_local=True, implicit=False, min_ratings=2, verbose=True, save_dir=None, compress_npz=False):
         """
         Creates sparse matrices from full URM.
 
@@ -506,6 +609,9 @@ class DataReader(object):
         save_names: list, default None
             List of the filenames of the resulting sparse matrices if save_local is True.
 
+        compress_npz: boolean, default False
+            Flag indicating whether the locally saved sparse matrices should be compressed.
+
 
         Returns
         -------
@@ -528,92 +634,107 @@ class DataReader(object):
                 raise
 
         if implicit:
-            URM.data = np.ones(len(URM.data))
+            URM.data = np.ones(len(URM.data), dtype=np.float32)
 
-        URM_csr = sps.csr_matrix(URM)
+        URM_csr = sps.csr_matrix(URM, dtype=np.float32)
+        URM_csr.sort_indices()
 
         if min_ratings >= 2:
             if verbose:
                 print('Removing users with less than ' + str(min_ratings) + ' ratings...')
 
-            URM_csr.data = np.ones(len(URM_csr.data))
-            user_mask = np.ediff1d(URM_csr.indptr) >= min_ratings
-            URM_csr = URM_csr[user_mask]
+            # Drop the rows of those users by compacting indptr, indices and data directly
+            user_counts = np.diff(URM_csr.indptr)
+            user_mask = user_counts >= min_ratings
+            entry_mask = np.repeat(user_mask, user_counts)
+            indptr = np.zeros(user_mask.sum() + 1, dtype=URM_csr.indptr.dtype)
+            indptr[1:] = np.cumsum(user_counts[user_mask])
+            URM_csr = sps.csr_matrix((URM_csr.data[entry_mask], URM_csr.indices[entry_mask], indptr),
+                                     shape=(len(indptr) - 1, URM_csr.shape[1]))
 
         if verbose:
             print('Splitting the full URM into train, test and validation matrices...')
 
-        # choice = np.random.choice(['train', 'test', 'valid'], p=split_ratio, size=len(URM.data))
-
-        # Keep the `split_ratio` per user and not per total ratings.
-        # Doing this through iteration, need to find a better solution
-        choice = []
-        for u in range(URM_csr.shape[0]):
-            indices = URM_csr.indices[URM_csr.indptr[u]: URM_csr.indptr[u+1]]
-            no_interactions = len(indices)
-            if no_interactions == 1:
-                choice.extend(['train'])
-            elif no_interactions == 2:
-                if split_ratio[1] == 0:
-                    first_choice = ['train', 'validation'][np.random.randint(2)]
-                    second_choice = 'train' if first_choice == 'validation' else 'validation'
-                else:
-                    first_choice = ['train', 'test'][np.random.randint(2)]
-                    second_choice = 'train' if first_choice == 'test' else 'test'
-                choice.extend([first_choice, second_choice])
-            else:
-                selection = np.random.choice(['train', 'test', 'valid'], p=split_ratio, size=no_interactions)
-
-                if (selection == 'train').sum() == 0 or \
-                    (split_ratio[1] != 0 and (selection == 'test').sum() == 0) or \
-                    (split_ratio[2] != 0 and (selection == 'validation').sum() == 0):
-                    no_trains = int(no_interactions * split_ratio[0])
-                    no_tests = math.ceil(no_interactions * split_ratio[1])
-
-                    selection = np.array(['train'] * no_interactions)
-                    possibilities = np.array(range(no_interactions))
-                    select_trains = np.random.choice(possibilities, size=no_trains, replace=False)
-                    remaining_possibilities = list(set(possibilities).difference(set(select_trains)))
-                    select_tests = np.random.choice(remaining_possibilities, size=no_tests, replace=False)
-                    select_validation = list(set(remaining_possibilities).difference(set(select_tests)))
-                    selection[select_tests] = 'test'
-                    selection[select_validation] = 'validation'
-
-                choice.extend(selection.tolist())
-
-        URM = sps.coo_matrix(URM_csr)
-        del URM_csr
-
-        choice = np.array(choice)
-        shape = URM.shape
-        URM_train = sps.coo_matrix((URM.data[choice == 'train'], (URM.row[choice == 'train'], URM.col[choice == 'train'])), shape=shape, dtype=np.float32)
-        URM_test = sps.coo_matrix((URM.data[choice == 'test'], (URM.row[choice == 'test'], URM.col[choice == 'test'])), shape=shape, dtype=np.float32)
-        URM_validation = sps.coo_matrix((URM.data[choice == 'valid'], (URM.row[choice == 'valid'], URM.col[choice == 'valid'])), shape=shape, dtype=np.float32)
-
-        self.URM_train = URM_train.tocsr()
-        self.URM_test = URM_test.tocsr()
-        self.URM_validation = URM_validation.tocsr()
+        # Labels of the interactions: 0 train, 1 test, 2 validation.
+        # Keep the `split_ratio` per user and not per total ratings: every user has at least one train interaction,
+        # then ceil(n * test ratio) test interactions and the remaining ones go to validation.
+        # The interactions of each user are assigned in a random order given by their rank within the user
+        user_counts = np.diff(URM_csr.indptr)
+        no_trains = np.maximum(np.floor(user_counts * split_ratio[0] + 1e-9), 1).astype(user_counts.dtype)
+        no_tests = np.minimum(np.ceil(user_counts * split_ratio[1] - 1e-9), user_counts - no_trains).astype(user_counts.dtype)
+
+        row_of = np.repeat(np.arange(URM_csr.shape[0], dtype=URM_csr.indices.dtype), user_counts)
+        shuffled = np.lexsort((np.random.random(len(URM_csr.data)), row_of))
+        rank = np.empty(len(URM_csr.data), dtype=URM_csr.indptr.dtype)
+        rank[shuffled] = np.arange(len(URM_csr.data)) - URM_csr.indptr[row_of]
+        del shuffled
+
+        choice = (rank >= no_trains[row_of]).astype(np.int8)
+        choice += rank >= (no_trains + no_tests)[row_of]
+        del rank
+
+        # Group the interactions by label in a single pass, each split is a contiguous slice of `order`.
+        # The stable sort keeps every slice in the row-major order of URM_csr, so the splits are built directly
+        # in CSR format without intermediate COO matrices
+        order = np.argsort(choice, kind='stable')
+        counts = np.bincount(choice, minlength=3)
+        bounds = np.concatenate([[0], np.cumsum(counts)])
+        del choice
+
+        splits = [self.select_entries(URM_csr, row_of, order[bounds[k]:bounds[k+1]]) for k in range(3)]
+        del URM_csr, row_of, order
+
+        self.URM_train, self.URM_test, self.URM_validation = splits
 
         if save_local and save_dir is not None:
             if verbose:
                 print('Saving matrices locally...')
 
-            sps.save_npz(os.path.join(save_dir, 'URM_train'), self.URM_train, compressed=True)
-            sps.save_npz(os.path.join(save_dir, 'URM_test'), self.URM_test, compressed=True)
-            sps.save_npz(os.path.join(save_dir, 'URM_validation'), self.URM_validation, compressed=True)
+            # Write to a temporary file and then replace, so that matrices memory-mapped from the previous files
+            # by load_csr_mmap stay valid
+            for name, matrix in zip(['URM_train', 'URM_test', 'URM_validation'],
+                                    [self.URM_train, self.URM_test, self.URM_validation]):
+                path = os.path.join(save_dir, name + '.npz')
+                sps.save_npz(path + '.tmp.npz', matrix, compressed=compress_npz)
+                os.replace(path + '.tmp.npz', path)
 
         return self.URM_train, self.URM_test, self.URM_validation
 
 
-    def get_CV_folds(self, URM=None, folds=10, verbose=True):
+    def get_CV_folds(self, URM=None, folds=10, verbose=True, prefetch=None, n_jobs=1):
         """
-        Generator function implementing cross-validation from interactions data file.
+        Implements cross-validation from interactions data file.
 
         :param URM: URM to use for generating the folds. If None, the attribute URM of the class will be used.
         :param folds: Number of CV folds
         :param verbose: True to print logging
+        :param prefetch: Number of folds built ahead on background threads while the current one is being used.
+            If 0 each fold is built only when requested. If None, one fold per thread, i.e. max(1, n_jobs)
+        :param n_jobs: Number of threads building the prefetched folds in parallel, -1 to use all CPUs.
+            At most `prefetch` folds are built at the same time, so n_jobs must not exceed it (or 1 if prefetch is 0)
 
-        Yields train and test matrices in CSR format
+        Returns a generator of train and test matrices in CSR format
+        """
+
+        # Checked here and not in the generator, so that wrong arguments raise at the call and not at the first fold
+        if n_jobs == 0 or n_jobs < -1:
+            raise ValueError('n_jobs must be a positive number of threads or -1 to use all CPUs. Given was {}.'.format(n_jobs))
+
+        n_jobs = (os.cpu_count() or 1) if n_jobs == -1 else n_jobs
+        if prefetch is None:
+            prefetch = n_jobs
+        elif prefetch < 0:
+            raise ValueError('prefetch must be a non-negative number of folds. Given was {}.'.format(prefetch))
+        elif n_jobs > max(prefetch, 1):
+            raise ValueError('n_jobs ({}) cannot exceed prefetch ({}) since only prefetch folds are built at the same '
+                             'time. Increase prefetch or leave it to None.'.format(n_jobs, prefetch))
+
+        return self._generate_CV_folds(URM, folds, verbose, prefetch, n_jobs)
+
+
+    def _generate_CV_folds(self, URM, folds, verbose, prefetch, n_jobs):
+        """
+        Generator function behind get_CV_folds, with prefetch and n_jobs already resolved to numbers of folds and threads
         """
 
         if verbose:
@@ -626,12 +747,126 @@ class DataReader(object):
                 print('URM is not initialized in ' + self.__class__.__name__ + '!', file=sys.stderr)
                 raise
 
-        choice = np.random.choice(range(folds), size=len(URM.data))
-        shape = URM.shape
-        for i in range(folds):
-            URM_test = sps.coo_matrix((URM.data[choice == i], (URM.row[choice == i], URM.col[choice == i])), shape=shape, dtype=np.float32)
-            URM_train = sps.coo_matrix((URM.data[choice != i], (URM.row[choice != i], URM.col[choice != i])), shape=shape, dtype=np.float32)
-            yield URM_train.tocsr(), URM_test.tocsr()
+        URM_csr = sps.csr_matrix(URM, dtype=np.float32)
+        URM_csr.sort_indices()
+        row_of = np.repeat(np.arange(URM_csr.shape[0], dtype=URM_csr.indices.dtype), np.diff(URM_csr.indptr))
+
+        # The test interactions of each fold are a contiguous slice of `order`, while the train mask buffer
+        # is allocated once per worker thread and reused by all the folds it builds
+        choice = np.random.choice(folds, size=URM_csr.nnz)
+        order = np.argsort(choice, kind='stable')
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(choice, minlength=folds))])
+        buffers = threading.local()
+
+        def build_fold(i):
+            if not hasattr(buffers, 'train_mask'):
+                buffers.train_mask = np.empty(URM_csr.nnz, dtype=np.bool_)
+            np.not_equal(choice, i, out=buffers.train_mask)
+            URM_train = self.select_entries(URM_csr, row_of, buffers.train_mask)
+            URM_test = self.select_entries(URM_csr, row_of, order[bounds[i]:bounds[i+1]])
+            return URM_train, URM_test
+
+        if prefetch == 0:
+            for i in range(folds):
+                yield build_fold(i)
+            return
+
+        # Threads share the URM without copies and numpy releases the GIL while gathering the entries
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            # While fold i is being used, exactly folds i+1, ..., i+prefetch are pending
+            pending = deque(executor.submit(build_fold, i) for i in range(min(prefetch, folds)))
+            for i in range(folds):
+                fold = pending.popleft().result()
+                if i + prefetch < folds:
+                    pending.append(executor.submit(build_fold, i + prefetch))
+                yield fold
+
+
+    def select_entries(self, URM_csr, row_of, selection):
+        """
+        Builds a CSR matrix with the shape of URM_csr that holds only the selected entries of it.
+
+        Parameters
+        ----------
+        URM_csr: scipy.sparse.csr_matrix
+            URM in CSR format with sorted indices.
+
+        row_of: np.ndarray
+            Row of each entry of URM_csr.
+
+        selection: np.ndarray
+            Boolean mask or increasing positions of the entries of URM_csr to keep.
+
+        Returns
+        -------
+        URM: scipy.sparse.csr_matrix
+            URM in CSR format with the selected entries.
+        """
+
+        indptr = np.zeros(URM_csr.shape[0] + 1, dtype=URM_csr.indptr.dtype)
+        indptr[1:] = np.cumsum(np.bincount(row_of[selection], minlength=URM_csr.shape[0]))
+        return sps.csr_matrix((URM_csr.data[selection].astype(np.float32, copy=False), URM_csr.indices[selection], indptr),
+                              shape=URM_csr.shape)
+
+
+    def load_csr_mmap(self, path):
+        """
+        Loads a CSR matrix saved with scipy.sparse.save_npz memory-mapping its arrays, so they are paged in
+        lazily instead of being read whole at load time. Pages are copy-on-write, the file is never modified.
+        Arrays of an uncompressed .npz are stored as-is inside the archive, hence they are mapped in place.
+        Compressed archives or other sparse formats are loaded with scipy.sparse.load_npz.
+
+        Parameters
+        ----------
+        path: str
+            Path of the .npz file.
+
+        Returns
+        -------
+        URM: scipy.sparse.csr_matrix
+        """
+
+        with zipfile.ZipFile(path) as zfile:
+            members = {info.filename: info for info in zfile.infolist()}
+            if any(info.compress_type != zipfile.ZIP_STORED for info in members.values()) or \
+                    np.load(zfile.open('format.npy')).item() not in (b'csr', 'csr'):
+                return sps.load_npz(path)
+            shape = tuple(np.load(zfile.open('shape.npy')))
+
+        arrays = {}
+        with open(path, 'rb') as f:
+            for name in ['data', 'indices', 'indptr']:
+                # Skip the local file header of the member to reach the .npy file, then its own header
+                f.seek(members[name + '.npy'].header_offset + 26)
+                name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+                f.seek(int(name_length) + int(extra_length), os.SEEK_CUR)
+
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    array_shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    array_shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+                if np.prod(array_shape) == 0:
+                    arrays[name] = np.empty(array_shape, dtype=dtype)
+                else:
+                    arrays[name] = np.memmap(path, dtype=dtype, mode='c', offset=f.tell(), shape=array_shape,
+                                             order='F' if fortran_order else 'C')
+
+        return sps.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape)
+
+
+    def get_transposed(self, name):
+        """
+        Returns the transposed CSR of the matrix stored in attribute `name`. The transposition is computed once and
+        reused until the attribute is assigned another matrix.
+        """
+        URM = getattr(self, name)
+        source, URM_T = self.transposed_cache.get(name, (None, None))
+        if source is None or source() is not URM:
+            URM_T = URM.T.tocsr()
+            self.transposed_cache[name] = (weakref.ref(URM), URM_T)
+        return URM_T
 
 
     def get_URM_full(self, transposed=False):
@@ -648,7 +883,7 @@ class DataReader(object):
     def get_URM_train(self, transposed=False):
         try:
             if transposed:
-                return self.URM_train.T.tocsr()
+                return self.get_transposed('URM_train')
             return self.URM_train
         except AttributeError:
             print('URM_train is not initialized in ' + self.__class__.__name__ + '!')
@@ -658,7 +893,7 @@ class DataReader(object):
     def get_URM_test(self, transposed=False):
         try:
             if transposed:
-                return self.URM_test.T.tocsr()
+                return self.get_transposed('URM_test')
             return self.URM_test
         except AttributeError:
             print('URM_test is not initialized in ' + self.__class__.__name__ + '!', file=sys.stderr)
@@ -668,7 +903,7 @@ class DataReader(object):
     def get_URM_validation(self, transposed=False):
         try:
             if transposed:
-                return self.URM_validation.T.tocsr()
+                return self.get_transposed('URM_validation')
             return self.URM_validation
         except AttributeError:
             print('URM_validation is not initialized in ' + self.__class__.__name__ + '!', file=sys.stderr)
@@ -692,71 +927,51 @@ class DataReader(object):
             valid_path = os.path.join(self.matrices_path, 'URM_validation.npz')
             urm_path = os.path.join(self.matrices_path, 'URM.npz')
 
-            # Read the build config and compare with current build
-            config_path = os.path.join(self.matrices_path, 'config.pkl')
-            if os.path.isfile(config_path):
-                with open(config_path, 'rb') as f:
-                    config = pickle.load(f)
+            # Read the build configs and compare with current build
+            try:
+                rebuild_urm = self.force_rebuild or \
+                              self.urm_config != self.load_config(os.path.join(self.matrices_path, 'urm_config.pkl'))
+                resplit = rebuild_urm or \
+                          self.split_config != self.load_config(os.path.join(self.matrices_path, 'split_config.pkl'))
+            except AttributeError:
+                print('config is not initialized in ' + self.__class__.__name__ + '!', file=sys.stderr)
+                rebuild_urm = resplit = True
+
+            if not resplit and os.path.isfile(train_path) and os.path.isfile(test_path) and os.path.isfile(valid_path):
+                if self.verbose:
+                    print('Loading train, test and validation matrices locally...')
 
-                try:
-                    if self.config != config:
-                        if self.verbose:
-                            print('Local matrices built differently from requested build. Setting force_rebuild = True.')
-                        self.force_rebuild = True
-                except AttributeError:
-                    print('config is not initialized in ' + self.__class__.__name__ + '!', file=sys.stderr)
-                    self.force_rebuild = True
+                self.URM_train = self.load_csr_mmap(train_path)
+                self.URM_test = self.load_csr_mmap(test_path)
+                self.URM_validation = self.load_csr_mmap(valid_path)
 
-            else:
+                if os.path.isfile(urm_path):
+                    self.URM = sps.load_npz(urm_path)
+
+            elif not rebuild_urm and os.path.isfile(urm_path):
                 if self.verbose:
-                    print('Configuration file not found. Setting force_rebuild = True.')
-                self.force_rebuild = True
-
-            if not self.force_rebuild:
-                if os.path.isfile(train_path) and os.path.isfile(test_path) and os.path.isfile(valid_path):
-                    if self.verbose:
-                        print('Loading train, test and validation matrices locally...')
-
-                    self.URM_train = sps.load_npz(train_path)
-                    self.URM_test = sps.load_npz(test_path)
-                    self.URM_validation = sps.load_npz(valid_path)
-
-                    if os.path.isfile(urm_path):
-                        self.URM = sps.load_npz(urm_path)
-
-                elif os.path.isfile(urm_path):
-                    if self.verbose:
-                        print('Building from full URM...')
-
-                    if os.path.isfile(urm_path):
-                        self.URM = sps.load_npz(urm_path)
-
-                        if split:
-                            self.URM_train, \
-                            self.URM_test, \
-                            self.URM_validation = self.split_urm(self.URM, split_ratio=self.split_ratio,
-                                                                save_local=self.save_local, min_ratings=self.min_ratings,
-                                                                verbose=self.verbose, save_dir=os.path.dirname(urm_path))
-                    else:
-                        if self.verbose:
-                            print("Full URM not found. Building from ratings' file...")
-                            
-                        if os.path.exists(ratings_file):
-                            self.build_local(ratings_file, split)
-                        else:
-                            self.build_remote(split)    
-                else:
-                    if self.verbose:
-                        print("Matrices not found. Building from ratings' file...")
+                    print('Building from full URM...')
 
-                    if os.path.exists(ratings_file):
-                        self.build_local(ratings_file, split)
-                    else:
-                        self.build_remote(split)
+                self.URM = sps.load_npz(urm_path)
+
+                if split:
+                    self.URM_train, \
+                    self.URM_test, \
+                    self.URM_validation = self.split_urm(self.URM, split_ratio=self.split_ratio,
+                                                        save_local=self.save_local, min_ratings=self.min_ratings,
+                                                        verbose=self.verbose, implicit=self.implicit,
+                                                        save_dir=os.path.dirname(urm_path), compress_npz=self.compress_npz)
+                    if self.save_local:
+                        self.save_config(os.path.dirname(urm_path), split)
 
             else:
                 if self.verbose:
-                    print("Rebuilding asked. Building from ratings' file...")
+                    if self.force_rebuild:
+                        print("Rebuilding asked. Building from ratings' file...")
+                    elif rebuild_urm:
+                        print("Local URM not found or built differently from requested build. Building from ratings' file...")
+                    else:
+                        print("Matrices not found. Building from ratings' file...")
 
                 if os.path.exists(ratings_file):
                     self.build_local(ratings_file, split)
@@ -772,6 +987,11 @@ class DataReader(object):
         Describes the full URM
         """
 
+        # Imported here since Utils_, seaborn and matplotlib are slow to import and only needed for describing
+        import seaborn as sns
+        import matplotlib.pyplot as plt
+        from Utils_ import gini
+
         print('Dataset:', self.DATASET_NAME)
 
         try:
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+@author: Ervin Dervishaj
+@email: vindervishaj@gmail.com
+'''
+
+import os
+import mmap
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import scipy.sparse as sps
+from datasets.DataReader import DataReader
+
+
+class TestDataset(DataReader):
+
+    DATASET_NAME = 'TestDataset'
+    dataset_dir = 'TestDataset'
+    data_file = 'ratings.csv'
+
+    def __init__(self, split=True, **kwargs):
+        super(TestDataset, self).__init__(**kwargs)
+        self.process(split)
+
+
+def is_memory_mapped(array):
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+class DataReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        TestDataset.all_datasets_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(TestDataset.all_datasets_dir, TestDataset.dataset_dir))
+
+        np.random.seed(1234)
+        with open(os.path.join(TestDataset.all_datasets_dir, TestDataset.dataset_dir, TestDataset.data_file), 'w') as f:
+            for user in range(50):
+                for item in np.random.choice(100, 10, replace=False):
+                    f.write('{},{},{}\n'.format(user, item, np.random.randint(1, 6)))
+
+    def tearDown(self):
+        shutil.rmtree(TestDataset.all_datasets_dir)
+
+    def test_process_memory_maps_uncompressed_cache(self):
+        built = TestDataset(verbose=False, compress_npz=False)
+        loaded = TestDataset(verbose=False, compress_npz=False)
+
+        for URM_built, URM_loaded in [(built.URM_train, loaded.URM_train),
+                                      (built.URM_test, loaded.URM_test),
+                                      (built.URM_validation, loaded.URM_validation)]:
+            self.assertIsInstance(URM_loaded, sps.csr_matrix)
+            self.assertEqual(URM_built.shape, URM_loaded.shape)
+            self.assertEqual(abs(URM_built - URM_loaded).sum(), 0)
+            for array in [URM_loaded.data, URM_loaded.indices, URM_loaded.indptr]:
+                self.assertTrue(is_memory_mapped(array), 'Cached matrix is not memory-mapped')
+
+    def test_process_loads_compressed_cache(self):
+        built = TestDataset(verbose=False, compress_npz=True)
+        loaded = TestDataset(verbose=False, compress_npz=True)
+
+        self.assertEqual(abs(built.URM_train - loaded.URM_train).sum(), 0)
+        self.assertFalse(is_memory_mapped(loaded.URM_train.data))
+
+    def test_build_recovers_from_damaged_raw_coo_cache(self):
+        built = TestDataset(verbose=False)
+        raw_coo_path = os.path.join(TestDataset.all_datasets_dir, TestDataset.dataset_dir, 'raw_coo.npz')
+
+        for kwargs in [{'force_rebuild': True}, {'remove_top_pop': 0.1}]:
+            # Truncate the cache as an interrupted run would
+            with open(raw_coo_path, 'r+b') as f:
+                f.truncate(os.path.getsize(raw_coo_path) // 2)
+
+            TestDataset(verbose=False, **kwargs)
+            # The ratings' file is parsed again and the cache rewritten in full
+            with np.load(raw_coo_path) as raw_coo:
+                self.assertEqual(len(raw_coo['r']), built.URM.nnz)
+        self.assertFalse(os.path.isfile(raw_coo_path + '.tmp.npz'))
+
+    def test_get_CV_folds_checks_arguments_at_call(self):
+        dataset = TestDataset(verbose=False, split=False)
+
+        for kwargs in [{'n_jobs': 0}, {'n_jobs': -2}, {'n_jobs': 4, 'prefetch': 2}, {'n_jobs': 2, 'prefetch': 0}]:
+            with self.assertRaises(ValueError):
+                dataset.get_CV_folds(folds=3, verbose=False, **kwargs)
+
+        np.random.seed(1234)
+        sequential = list(dataset.get_CV_folds(folds=3, verbose=False, prefetch=0))
+        np.random.seed(1234)
+        parallel = list(dataset.get_CV_folds(folds=3, verbose=False, n_jobs=2))
+        for (train, test), (train_parallel, test_parallel) in zip(sequential, parallel):
+            self.assertEqual(abs(train - train_parallel).sum(), 0)
+            self.assertEqual(abs(test - test_parallel).sum(), 0)
+
+    def config_path(self, name):
+        return os.path.join(TestDataset.all_datasets_dir, TestDataset.dataset_dir, name)
+
+    def test_split_config_change_resplits_saved_URM(self):
+        built = TestDataset(verbose=False)
+
+        for kwargs in [{'split_ratio': [0.8, 0.1, 0.1]}, {'min_ratings': 11}]:
+            with mock.patch.object(DataReader, 'read_interactions', side_effect=AssertionError('URM rebuilt')), \
+                 mock.patch.object(DataReader, 'build_URM', side_effect=AssertionError('URM rebuilt')), \
+                 mock.patch.object(DataReader, 'split_urm', autospec=True, side_effect=DataReader.split_urm) as split_urm:
+                resplit = TestDataset(verbose=False, **kwargs)
+
+            split_urm.assert_called_once()
+            self.assertEqual(abs(resplit.URM - built.URM).sum(), 0)
+            self.assertEqual(resplit.load_config(self.config_path('split_config.pkl')), resplit.split_config)
+
+        # Every user has exactly 10 ratings, so none is left with min_ratings=11
+        self.assertEqual(resplit.URM_train.nnz, 0)
+
+    def test_urm_config_change_rebuilds_URM(self):
+        built = TestDataset(verbose=False)
+
+        with mock.patch.object(DataReader, 'build_URM', autospec=True, side_effect=DataReader.build_URM) as build_URM:
+            rebuilt = TestDataset(verbose=False, remove_top_pop=0.1)
+
+        build_URM.assert_called_once()
+        self.assertLess(rebuilt.URM.shape[1], built.URM.shape[1])
+        self.assertEqual(rebuilt.URM_train.shape, rebuilt.URM.shape)
+        self.assertEqual(rebuilt.load_config(self.config_path('urm_config.pkl')), rebuilt.urm_config)
+
+    def test_build_without_split_discards_saved_splits(self):
+        TestDataset(verbose=False)
+        rebuilt = TestDataset(verbose=False, remove_top_pop=0.1, split=False)
+        self.assertFalse(os.path.isfile(self.config_path('split_config.pkl')))
+
+        # The train, test and validation files on disk come from the previous URM and must not be loaded
+        with mock.patch.object(DataReader, 'split_urm', autospec=True, side_effect=DataReader.split_urm) as split_urm:
+            resplit = TestDataset(verbose=False, remove_top_pop=0.1)
+
+        split_urm.assert_called_once()
+        self.assertEqual(resplit.URM_train.shape, rebuilt.URM.shape)
+        self.assertEqual(resplit.URM_train.nnz + resplit.URM_test.nnz + resplit.URM_validation.nnz, rebuilt.URM.nnz)
+
+    def test_build_without_save_local_writes_no_configs(self):
+        TestDataset(verbose=False, save_local=False)
+
+        self.assertFalse(os.path.isfile(self.config_path('urm_config.pkl')))
+        self.assertFalse(os.path.isfile(self.config_path('split_config.pkl')))
+
+
+class SplitURMTestCase(unittest.TestCase):
+
+    # Number of interactions of each user and the expected train, test and validation interactions per user
+    # for the split ratio [0.6, 0.2, 0.2]
+    quotas = {1: (1, 0, 0), 2: (1, 1, 0), 3: (1, 1, 1), 5: (3, 1, 1), 7: (4, 2, 1), 10: (6, 2, 2), 25: (15, 5, 5)}
+
+    def setUp(self):
+        np.random.seed(1234)
+        rows, cols = [], []
+        for user, n in enumerate(sorted(self.quotas)):
+            rows.extend([user] * n)
+            cols.extend(np.random.choice(40, n, replace=False))
+        self.URM = sps.coo_matrix((np.random.randint(1, 6, len(rows)).astype(np.float32), (rows, cols)),
+                                  shape=(len(self.quotas), 40))
+        self.reader = DataReader(verbose=False)
+
+    def split(self, split_ratio=[0.6, 0.2, 0.2]):
+        return self.reader.split_urm(self.URM.copy(), split_ratio=split_ratio, save_local=False, min_ratings=1,
+                                     verbose=False)
+
+    def test_splits_partition_the_URM(self):
+        URM_train, URM_test, URM_validation = self.split()
+
+        self.assertEqual(abs(URM_train + URM_test + URM_validation - self.URM.tocsr()).sum(), 0)
+        self.assertEqual(URM_train.nnz + URM_test.nnz + URM_validation.nnz, self.URM.nnz)
+        for URM_a, URM_b in [(URM_train, URM_test), (URM_train, URM_validation), (URM_test, URM_validation)]:
+            self.assertEqual(URM_a.multiply(URM_b).nnz, 0)
+
+    def test_splits_follow_per_user_quotas(self):
+        URM_train, URM_test, URM_validation = self.split()
+
+        counts = np.stack([np.diff(URM.indptr) for URM in [URM_train, URM_test, URM_validation]], axis=1)
+        self.assertTrue(np.all(counts[:, 0] >= 1))
+        for user, n in enumerate(sorted(self.quotas)):
+            self.assertEqual(tuple(counts[user]), self.quotas[n], 'Wrong split of a user with {} interactions'.format(n))
+
+    def test_zero_ratio_leaves_split_empty(self):
+        URM_train, URM_test, URM_validation = self.split([0.5, 0.0, 0.5])
+        self.assertEqual(URM_test.nnz, 0)
+        self.assertTrue(np.all(np.diff(URM_train.indptr) >= 1))
+
+        URM_train, URM_test, URM_validation = self.split([0.7, 0.3, 0.0])
+        self.assertEqual(URM_validation.nnz, 0)
+        self.assertEqual(URM_train.nnz + URM_test.nnz, self.URM.nnz)
+
+    def test_same_seed_gives_same_split(self):
+        np.random.seed(42)
+        first = self.split()
+        np.random.seed(42)
+        second = self.split()
+
+        for URM_first, URM_second in zip(first, second):
+            self.assertEqual((URM_first != URM_second).nnz, 0)
+            self.assertEqual(URM_first.nnz, URM_second.nnz)
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -79,7 +79,7 @@ class Movielens(DataReader):
         self.data_file = tmp[1]
 
         try:
-            self.config['version'] = self.version
+            self.urm_config['version'] = self.version
         except AttributeError:
             pass
 